@@ -1,6 +1,8 @@
 import torch
 import math
 import itertools
+import functools
+from torch.utils.data import IterableDataset, get_worker_info
 
 
 # Adding extra padding is an easy way to improve performance, as it gives the
@@ -30,66 +32,177 @@ class Dataset:
         self.dic[self.end_token] = "="
         self.dic[self.eos_token] = ""
 
-    def make_numbers(self, shape, number_length=None):
+        # Maps (length, device, dtype) to the place values of a length-digit number
+        self._bases_cache = {}
+        # Maps (length, device) to the digit positions 0, ..., length - 1
+        self._positions_cache = {}
+        # One random generator per device, so the batches can be seeded independently of
+        # the global RNG. Not used when compiled, see get_generator.
+        self._generators = {}
+        self._seed = None
+        self.compiled = False
+
+    def __getstate__(self):
+        # Compiled functions and device generators can't be pickled into DataLoader
+        # workers, so each worker compiles its own copy and makes new generators. The
+        # device caches are dropped too, since they may hold cuda tensors.
+        state = self.__dict__.copy()
+        state.pop("_make_batch", None)
+        for key in ("_generators", "_bases_cache", "_positions_cache", "_device_primes"):
+            if key in state:
+                state[key] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.compiled:
+            self.compile()
+
+    def manual_seed(self, seed):
+        """Seed the generators used for all future batches."""
+        self._seed = seed
+        self._generators = {}
+
+    def get_generator(self, device):
+        # torch.compile can't trace a Generator argument, so each random call would become a
+        # graph break. A compiled dataset uses the global RNG instead, which means
+        # manual_seed has no effect on it. DataLoader workers still differ, since each
+        # worker seeds its own global RNG.
+        if self.compiled:
+            return None
+        device = torch.device("cpu") if device is None else torch.device(device)
+        if device not in self._generators:
+            generator = torch.Generator(device=device)
+            # Without an explicit seed, draw one from the global RNG, so torch.manual_seed
+            # still makes runs reproducible.
+            seed = self._seed
+            if seed is None:
+                seed = torch.randint(2**63 - 1, ()).item()
+            self._generators[device] = generator.manual_seed(seed)
+        return self._generators[device]
+
+    def get_bases(self, length, device, dtype=torch.int64):
+        key = (length, device, dtype)
+        if key not in self._bases_cache:
+            # Computed with Python ints instead of a generic pow kernel. Values too large
+            # for dtype wrap around, like the integer overflow of torch.pow, so very long
+            # numbers still generate (garbled) batches instead of crashing.
+            bits = torch.iinfo(dtype).bits
+            self._bases_cache[key] = torch.tensor(
+                [
+                    (self.base**i + 2 ** (bits - 1)) % 2**bits - 2 ** (bits - 1)
+                    for i in range(length - 1, -1, -1)
+                ],
+                device=device,
+                dtype=dtype,
+            )
+        return self._bases_cache[key]
+
+    def get_positions(self, length, device):
+        key = (length, device)
+        if key not in self._positions_cache:
+            # Copied from a host list like the bases, rather than an async arange kernel, so
+            # the cached tensor is ready for any stream that reads it later.
+            self._positions_cache[key] = torch.tensor(list(range(length)), device=device)
+        return self._positions_cache[key]
+
+    def number_dtype(self, number_length):
+        """Use int32 when it can hold the product of two number_length-digit numbers, which
+        covers every op we train on. This halves the memory traffic of the generation."""
+        if self.base ** (2 * number_length) < 2**31:
+            return torch.int32
+        return torch.int64
+
+    def make_numbers(self, shape, number_length=None, device=None):
         if number_length is None:
             number_length = self.number_length
-        digits = torch.randint(self.base, shape + (number_length,))
-        n_digits = torch.randint(number_length, shape)
-        mask = torch.arange(number_length) < n_digits[..., None]
-        digits[mask] = 0
-        bases = torch.pow(self.base, torch.arange(number_length - 1, -1, -1)).unsqueeze(
-            0
+        dtype = self.number_dtype(number_length)
+        generator = self.get_generator(device)
+        digits = torch.randint(
+            self.base,
+            shape + (number_length,),
+            device=device,
+            dtype=dtype,
+            generator=generator,
+        )
+        n_digits = torch.randint(
+            number_length, shape, device=device, dtype=dtype, generator=generator
         )
-        return (digits * bases).sum(dim=-1)
+        mask = self.get_positions(number_length, digits.device) < n_digits[..., None]
+        digits[mask] = 0
+        bases = self.get_bases(number_length, digits.device, dtype)
+        return (digits * bases).sum(dim=-1, dtype=dtype)
 
     def to_digits(self, numbers, length=None):
         if length is None:
             length = self.number_length
 
-        # Convert numbers to digits
-        tensor = numbers.unsqueeze(1).repeat(1, length)
-        bases = torch.pow(
-            self.base, torch.arange(length - 1, -1, -1, device=tensor.device)
-        ).unsqueeze(0)
-        digits = (tensor // bases) % self.base
+        # Convert numbers to digits. Works for any shape of numbers, so several numbers of
+        # the same length can be converted together, with a single kernel launch per op.
+        bases = self.get_bases(length, numbers.device, numbers.dtype)
+        digits = (numbers.unsqueeze(-1) // bases) % self.base
 
-        # Mask leading zeros
-        mask = digits.cumsum(1) == 0
-        mask[:, -1] = False
+        # Mask leading zeros. A running max over a bool tensor finds them without writing
+        # an int64 cumsum.
+        mask = (digits != 0).cummax(dim=-1).values.logical_not()
+        mask[..., -1] = False
         digits[mask] = self.padding_token
         if self.flip:
-            return torch.flip(digits, [1])
+            return torch.flip(digits, [-1])
         return digits
 
     def move_padding_to_end(self, tensor, end=True):
         """Move all padding tokens in each row to the end without reordering the rest."""
 
-        # Create a tensor with large values where there's padding and row-wise indices elsewhere
-        # This allows us to "sort" the padding to the end, while keeping everything else in its
-        # original order.
-        sorting_tensor = torch.where(
-            tensor == self.padding_token,
-            tensor.size(1) if end else -tensor.size(1),
-            torch.arange(tensor.size(1), device=tensor.device),
-        )
-
-        # Get the indices that would sort the tensor
-        _, sorted_indices = sorting_tensor.sort(dim=1)
-
-        # Use the sorted indices to rearrange the original tensor
-        sorted_tensor = torch.gather(tensor, 1, sorted_indices)
+        # This is a stable partition, so instead of sorting we can compute the destination of
+        # each token directly: The non-padding tokens are placed in the order they appear,
+        # and the padding tokens are placed after (or before) all of them.
+        mask = tensor != self.padding_token
+        keep_pos = mask.cumsum(dim=1) - 1
+        pad_pos = (~mask).cumsum(dim=1) - 1
+        if end:
+            pad_pos += mask.sum(dim=1, keepdim=True)
+        else:
+            keep_pos += (~mask).sum(dim=1, keepdim=True)
+        dest = torch.where(mask, keep_pos, pad_pos)
+
+        # Every position is written exactly once, since dest is a permutation of each row.
+        return torch.empty_like(tensor).scatter_(1, dest, tensor)
+
+    def assemble(self, bs, parts, device):
+        """Lay out the parts side by side in a single preallocated tensor. Each part is
+        either a token, which fills one column, or a tensor of shape (bs, n)."""
+        widths = [1 if isinstance(part, int) else part.shape[1] for part in parts]
+        res = torch.empty((bs, sum(widths)), dtype=torch.int64, device=device)
+        start = 0
+        for part, width in zip(parts, widths):
+            res[:, start : start + width] = part
+            start += width
+        return res
 
-        return sorted_tensor
+    def generate_batch(self, bs, device=None):
+        """Generate a batch of bs examples directly on the given device."""
+        res = self._make_batch(bs, device)
+        assert res.shape == (bs, self.seq)
+        return res
 
-    def generate_batch(self, bs):
+    def _make_batch(self, bs, device):
         # TODO: Could insert COT padding here
-        res = self._generate_batch(bs)
+        res = self._generate_batch(bs, device)
         res = self.move_padding_to_end(res)
         res[res == self.n_tokens] = self.padding_token
-        assert res.shape == (bs, self.seq)
         return res
 
-    def _generate_batch(self, tokens):
+    def compile(self):
+        """Compile the batch generation with torch.compile, fusing the many small ops.
+        Dynamo caches the graphs on the shared _make_batch code, across all datasets of a
+        curriculum run. So we let automatic dynamic shapes turn the batch size and number
+        length into symbols once they change, instead of compiling a graph per value and
+        running into the recompile limit."""
+        self.compiled = True
+        self._make_batch = torch.compile(self._make_batch, dynamic=None)
+
+    def _generate_batch(self, bs, device):
         assert False, "Not implemented"
 
     def repr_example(self, example):
@@ -125,23 +238,25 @@ class AddModDataset(Dataset):
         self.dic[self.separator_token] = "+"
         self.dic[self.separator_token2] = "%"
 
-    def _generate_batch(self, bs):
-        a, b = self.make_numbers((2, bs))
-        c = self.make_numbers((bs,), (self.number_length + 1) // 2)
+    def _generate_batch(self, bs, device):
+        a, b = self.make_numbers((2, bs), device=device)
+        c = self.make_numbers((bs,), (self.number_length + 1) // 2, device)
         out = (a + b) % torch.clip(c, min=1)
-        return torch.cat(
+        a, b, c, out = self.to_digits(torch.stack([a, b, c, out]))
+        return self.assemble(
+            bs,
             [
-                torch.full((bs, 1), self.start_token),
-                self.to_digits(a),
-                torch.full((bs, 1), self.separator_token),
-                self.to_digits(b),
-                torch.full((bs, 1), self.separator_token2),
-                self.to_digits(c),
-                torch.full((bs, 1), self.end_token),
-                self.to_digits(out),
-                torch.full((bs, 1), self.eos_token),
+                self.start_token,
+                a,
+                self.separator_token,
+                b,
+                self.separator_token2,
+                c,
+                self.end_token,
+                out,
+                self.eos_token,
             ],
-            dim=1,
+            device,
         )
 
     @property
@@ -168,21 +283,23 @@ class BinaryOpDataset(Dataset):
         self.dic[self.separator_token] = sep
         self.min_b = min_b
 
-    def _generate_batch(self, bs):
-        a, b = self.make_numbers((2, bs))
+    def _generate_batch(self, bs, device):
+        a, b = self.make_numbers((2, bs), device=device)
         b = torch.clip(b, min=self.min_b)
         out = self.func(a, b)
-        return torch.cat(
+        a_digits, b_digits = self.to_digits(torch.stack([a, b]))
+        return self.assemble(
+            bs,
             [
-                torch.full((bs, 1), self.start_token),
-                self.to_digits(a),
-                torch.full((bs, 1), self.separator_token),
-                self.to_digits(b),
-                torch.full((bs, 1), self.end_token),
+                self.start_token,
+                a_digits,
+                self.separator_token,
+                b_digits,
+                self.end_token,
                 self.to_digits(out, length=self.out_length),
-                torch.full((bs, 1), self.eos_token),
+                self.eos_token,
             ],
-            dim=1,
+            device,
         )
 
     @property
@@ -204,24 +321,26 @@ class DivModDataset(Dataset):
         self.dic[self.separator_token] = "/%"
         self.dic[self.output_separator] = ","
 
-    def _generate_batch(self, bs):
-        a, b = self.make_numbers((2, bs), self.base)
+    def _generate_batch(self, bs, device):
+        a, b = self.make_numbers((2, bs), self.base, device)
         b = torch.clip(b, min=1)
         div = a // b
         mod = a % b
-        return torch.cat(
+        a, b, div, mod = self.to_digits(torch.stack([a, b, div, mod]))
+        return self.assemble(
+            bs,
             [
-                torch.full((bs, 1), self.start_token),
-                self.to_digits(a),
-                torch.full((bs, 1), self.separator_token),
-                self.to_digits(b),
-                torch.full((bs, 1), self.end_token),
-                self.to_digits(div),
-                torch.full((bs, 1), self.output_separator),
-                self.to_digits(mod),
-                torch.full((bs, 1), self.eos_token),
+                self.start_token,
+                a,
+                self.separator_token,
+                b,
+                self.end_token,
+                div,
+                self.output_separator,
+                mod,
+                self.eos_token,
             ],
-            dim=1,
+            device,
         )
 
     @property
@@ -235,22 +354,31 @@ class FactorDataset(Dataset):
         self.dic[self.separator_token] = "*"
         self.primes = None
         self.primes_length = 0
-
-    def get_primes(self, number_length):
-        if self.primes_length == number_length:
-            return self.primes
+        # Copies of the primes on each device we generate on
+        self._device_primes = {}
+
+    def get_primes(self, number_length, device=None):
+        device = torch.device("cpu") if device is None else torch.device(device)
+        if self.primes_length != number_length:
+            self._sieve_primes(number_length)
+        if device not in self._device_primes:
+            self._device_primes[device] = self.primes.to(device)
+        return self._device_primes[device]
+
+    def _sieve_primes(self, number_length):
         n = self.base**self.number_length
         sieve = torch.ones(n, dtype=torch.bool)
         # We include 1, but not 0
         sieve[0] = False
-        for i in range(2, n):
+        # Every composite below n has a prime factor of at most sqrt(n)
+        for i in range(2, math.isqrt(n) + 1):
             if sieve[i]:
                 sieve[i * i :: i] = False
         self.primes = torch.nonzero(sieve).squeeze()
         self.primes_length = self.number_length
-        return self.primes
+        self._device_primes = {}
 
-    @property
+    @functools.cached_property
     def max_factors(self):
         return int(math.log2(self.base) * self.number_length)
 
@@ -261,12 +389,15 @@ class FactorDataset(Dataset):
         # actually one less, because we need one separator less than factors
         return self.number_length + 2 * self.max_factors + 2
 
-    def _generate_batch(self, bs):
-        primes = self.get_primes(self.number_length)
+    def _generate_batch(self, bs, device):
+        primes = self.get_primes(self.number_length, device)
         # A random number contains the factor p with probability 1/p
         weights = 1 / primes
         indices = torch.multinomial(
-            weights, num_samples=bs * self.max_factors, replacement=True
+            weights,
+            num_samples=bs * self.max_factors,
+            replacement=True,
+            generator=self.get_generator(device),
         )
         sampled_primes = primes[indices].reshape(bs, self.max_factors)
         # Products may be too large. Let's fix that
@@ -286,22 +417,43 @@ class FactorDataset(Dataset):
         filtered_primes = sampled_primes
         prods = torch.prod(filtered_primes, dim=1)
         filtered_primes = filtered_primes.sort(dim=1).values
-        parts = [
-            torch.full((bs, 1), self.start_token),
-            self.to_digits(prods),
-            torch.full((bs, 1), self.end_token),
-        ]
-        for i in range(self.max_factors):
-            parts += [
-                self.to_digits(filtered_primes[:, i]),
-                torch.full((bs, 1), self.separator_token),
-            ]
-            # If 1, change it to padding
-            parts[-2][filtered_primes[:, i] == 1] = self.padding_token
-            parts[-1][filtered_primes[:, i] == 1] = self.padding_token
+        # Convert all factors at once, each followed by a separator
+        factor_digits = self.to_digits(filtered_primes)
+        factors = torch.empty(
+            (bs, self.max_factors, factor_digits.shape[-1] + 1),
+            dtype=torch.int64,
+            device=device,
+        )
+        factors[..., :-1] = factor_digits
+        factors[..., -1] = self.separator_token
+        # If 1, change it to padding
+        factors[filtered_primes == 1] = self.padding_token
         # Replace last separator with EOS
-        parts[-1] = torch.full((bs, 1), self.eos_token)
-        res = torch.cat(parts, dim=1)
+        factors[:, -1, -1] = self.eos_token
+        res = self.assemble(
+            bs,
+            [self.start_token, self.to_digits(prods), self.end_token, factors.flatten(1)],
+            device,
+        )
         res = self.move_padding_to_end(res)
         res = res[:, : self.seq]
         return res
+
+
+class BatchStream(IterableDataset):
+    """Endless stream of batches from a dataset, for use in a DataLoader with batch_size=None.
+    Each worker reseeds its copy of the dataset with its own seed, so the workers don't
+    repeat each other's batches."""
+
+    def __init__(self, dataset, bs):
+        self.dataset = dataset
+        self.bs = bs
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            self.dataset.manual_seed(worker_info.seed)
+        while True:
+            with torch.no_grad():
+                batch = self.dataset.generate_batch(self.bs)
+            yield batch
@@ -276,7 +276,11 @@ class AdditionModel(nn.Module):
 
     @torch.no_grad()
     def print_examples(self, num_examples=3, must_include_a_wrong=False):
-        examples = self.ds.generate_batch(num_examples).to(self.embedding.weight.device)
+        device = self.embedding.weight.device
+        examples = self.ds.generate_batch(num_examples, device)
+        # Replacements are taken from spare batches of the same size, so a compiled
+        # dataset doesn't see another batch size.
+        spare, j = examples, num_examples
         i = 0
         while i < num_examples:
             example = examples[i]
@@ -287,7 +291,10 @@ class AdditionModel(nn.Module):
             is_correct = torch.all(true_answer == raw_prediction)
             # Get at least one wrong example each time
             if is_correct and i == num_examples - 1 and must_include_a_wrong:
-                examples[i] = self.ds.generate_batch(1)[0]
+                if j == num_examples:
+                    spare, j = self.ds.generate_batch(num_examples, device), 0
+                examples[i] = spare[j]
+                j += 1
                 continue
             print("Example:", self.ds.repr_example(example))
             print(
@@ -1,9 +1,12 @@
 import argparse
+import contextlib
 import itertools
+import operator
 import torch
 import tqdm
 from collections import Counter
 import torch.nn.functional as F
+from torch.utils.data import DataLoader
 
 import dataset as my_datasets
 from model import AdditionModel
@@ -12,6 +15,8 @@ from model import AdditionModel
 def main():
     # Needed to enable tensor cores
     torch.set_float32_matmul_precision("medium")
+    # Our input shapes are fixed for each number length, so autotuning pays off
+    torch.backends.cudnn.benchmark = True
 
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
@@ -76,8 +81,24 @@ def main():
         default=10,
     )
     parser.add_argument("--compile", action="store_true")
+    parser.add_argument(
+        "--amp", action="store_true", help="Use bfloat16 autocast on cuda"
+    )
     parser.add_argument("--flip", action="store_true", help="Flip order of numbers")
     parser.add_argument("--device", type=str, default=None)
+    parser.add_argument(
+        "--data-device",
+        type=str,
+        default=None,
+        help="Device to generate the data on. Defaults to --device",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=0,
+        help="DataLoader workers generating batches on the cpu. 0 generates in-process. "
+        "Can't be combined with --data-device",
+    )
     parser.add_argument(
         "--num-heads",
         type=int,
@@ -85,6 +106,8 @@ def main():
         help="The number of heads/rank in transformer/mlp",
     )
     args = parser.parse_args()
+    if args.num_workers > 0 and args.data_device is not None:
+        parser.error("--data-device can't be used with --num-workers > 0")
 
     dataset = make_dataset(args)
 
@@ -102,10 +125,16 @@ def main():
     print(f"The model has {num_params} parameters")
 
     if args.compile:
-        model = torch.compile(model)
+        dataset.compile()
     manual_training(model, dataset, args)
 
 
+# The ops are module level functions rather than lambdas, so the datasets can be pickled
+# into DataLoader worker processes, which are spawned on macOS and Windows.
+def square_mod(a, b):
+    return a**2 % b
+
+
 def make_dataset(args, number_length=1):
     kvargs = dict(
         base=args.base,
@@ -119,21 +148,21 @@ def make_dataset(args, number_length=1):
         return my_datasets.DivModDataset(**kvargs)
     elif args.op == "add":
         return my_datasets.BinaryOpDataset(
-            func=(lambda a, b: a + b),
+            func=operator.add,
             sep="+",
             out_length=number_length + 1,
             **kvargs,
         )
     elif args.op == "mult":
         return my_datasets.BinaryOpDataset(
-            func=(lambda a, b: a * b),
+            func=operator.mul,
             sep="*",
             out_length=2 * number_length,
             **kvargs,
         )
     elif args.op == "div":
         return my_datasets.BinaryOpDataset(
-            func=(lambda a, b: a // b),
+            func=operator.floordiv,
             sep="//",
             min_b=1,
             out_length=number_length,
@@ -141,7 +170,7 @@ def make_dataset(args, number_length=1):
         )
     elif args.op == "mod":
         return my_datasets.BinaryOpDataset(
-            func=(lambda a, b: a % b),
+            func=operator.mod,
             sep="%",
             min_b=1,
             out_length=number_length,
@@ -149,7 +178,7 @@ def make_dataset(args, number_length=1):
         )
     elif args.op == "sqmod":
         return my_datasets.BinaryOpDataset(
-            func=(lambda a, b: a**2 % b),
+            func=square_mod,
             sep="^2 %",
             min_b=1,
             out_length=2 * number_length,
@@ -208,6 +237,80 @@ def validation_step(model, batch):
     return torch.all(preds * mask == truth * mask, dim=1).float().mean()
 
 
+def autocast(use_amp):
+    # Only enter torch.autocast when needed, since older torch releases reject
+    # device types like mps, even with enabled=False.
+    if use_amp:
+        return torch.autocast("cuda", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def generate_data(dataset, bs, device, data_device, chunk_size=2**20):
+    """Generates bs examples on data_device and moves them to device. When generating on the
+    cpu for a cuda device, the data is pinned first, so the copy doesn't block.
+    We generate a whole epoch at a time, since many small generate_batch calls are dominated
+    by launch overhead. But very large requests are split into chunks of chunk_size examples,
+    to bound the memory used by the intermediate tensors of the generation."""
+    if bs > chunk_size:
+        data = torch.empty((bs, dataset.seq), dtype=torch.long, device=device)
+        for i in range(0, bs, chunk_size):
+            n = min(chunk_size, bs - i)
+            data[i : i + n] = generate_data(dataset, n, device, data_device, chunk_size)
+        return data
+    data = dataset.generate_batch(bs, data_device)
+    if data.device.type == "cpu" and device.type == "cuda":
+        return data.pin_memory().to(device, non_blocking=True)
+    return data.to(device)
+
+
+def make_batch_stream(dataset, args, device):
+    """Endless iterator of batches, generated in parallel by DataLoader worker processes."""
+    loader = DataLoader(
+        my_datasets.BatchStream(dataset, args.batch_size),
+        batch_size=None,
+        num_workers=args.num_workers,
+        prefetch_factor=4,
+        pin_memory=device.type == "cuda",
+    )
+    return iter(loader)
+
+
+def take_batches(batches, n, device):
+    for batch in itertools.islice(batches, n):
+        # Only a copy from pinned memory to cuda is safe to do without blocking
+        yield batch.to(device, non_blocking=device.type == "cuda" and batch.is_pinned())
+
+
+class BatchPrefetcher:
+    """Generates data on a side CUDA stream, so it overlaps with the work queued on the
+    default stream. On other devices the data is simply generated when preloaded."""
+
+    def __init__(self, device, data_device):
+        self.device = device
+        self.data_device = data_device
+        self.stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+        self.next_batch = None
+
+    @torch.no_grad()
+    def preload(self, dataset, bs):
+        if self.stream is None:
+            self.next_batch = generate_data(dataset, bs, self.device, self.data_device)
+            return
+        # The generation may read tensors the dataset just cached on the default stream
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.stream):
+            self.next_batch = generate_data(dataset, bs, self.device, self.data_device)
+
+    def next(self):
+        batch, self.next_batch = self.next_batch, None
+        if self.stream is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(self.stream)
+            # The batch was allocated on the side stream, but is used on this one
+            batch.record_stream(current)
+        return batch
+
+
 def manual_training(model, dataset, args):
     if args.device is not None:
         device = torch.device(args.device)
@@ -218,38 +321,62 @@ def manual_training(model, dataset, args):
     else:
         device = torch.device("cpu")
     model = model.to(device)
+    if args.compile:
+        model = torch.compile(model)
+    # bfloat16 has the same range as float32, so unlike float16 we don't need a GradScaler
+    use_amp = args.amp and device.type == "cuda"
+    data_device = device if args.data_device is None else torch.device(args.data_device)
 
     batch_size = args.batch_size
     optimizer = model.configure_optimizers()
+    # The worker processes keep generating batches for the current dataset in the background,
+    # so we only restart them when the dataset changes.
+    batches = None
+    if args.num_workers > 0:
+        batches = make_batch_stream(dataset, args, device)
+    else:
+        prefetcher = BatchPrefetcher(device, data_device)
 
     # Standard PyTorch Training Loop
     time_to_success = Counter()
     for epoch in range(args.epochs):
         train_batches = 1000
-        with torch.no_grad():
-            train_data = dataset.generate_batch(batch_size * train_batches).to(device)
+        val_batches = 100
+        if batches is None:
+            with torch.no_grad():
+                train_data = generate_data(
+                    dataset, batch_size * train_batches, device, data_device
+                )
+            # The validation data only depends on the current dataset, so we can generate
+            # it while the training steps are running.
+            prefetcher.preload(dataset, batch_size * val_batches)
+            train_iter = train_data.split(batch_size)
+        else:
+            train_iter = take_batches(batches, train_batches, device)
 
         # Training Loop
         model.train()
-        for batch_idx in tqdm.tqdm(range(train_batches)):
-            batch = train_data[batch_idx * batch_size : (batch_idx + 1) * batch_size]
+        for batch in tqdm.tqdm(train_iter, total=train_batches):
             optimizer.zero_grad()
-            loss = training_step(model, batch)
+            with autocast(use_amp):
+                loss = training_step(model, batch)
             loss.backward()
             optimizer.step()
 
         # Validation Loop
-        accs = []
+        # Keep the sum on the device, so we only sync once per epoch
+        acc_sum = torch.zeros((), device=device)
         model.eval()
         with torch.no_grad():
-            val_batches = 100
-            val_data = dataset.generate_batch(batch_size * val_batches).to(device)
-
-            for batch_idx in tqdm.tqdm(range(val_batches)):
-                batch = val_data[batch_idx * batch_size : (batch_idx + 1) * batch_size]
-                acc = validation_step(model, batch)
-                accs.append(acc)
-        acc = torch.mean(torch.tensor(accs))
+            if batches is None:
+                val_iter = prefetcher.next().split(batch_size)
+            else:
+                val_iter = take_batches(batches, val_batches, device)
+
+            for batch in tqdm.tqdm(val_iter, total=val_batches):
+                with autocast(use_amp):
+                    acc_sum += validation_step(model, batch)
+        acc = (acc_sum / val_batches).item()
         print(f"Validation acc: {acc:.5}")
 
         # Print some examples. Try to always include an example where the model is wrong.
@@ -262,7 +389,11 @@ def manual_training(model, dataset, args):
         if acc > args.acc_next:
             print(f"Switching to number length {dataset.number_length+1}")
             dataset = make_dataset(args, number_length=dataset.number_length + 1)
+            if args.compile:
+                dataset.compile()
             model.ds = dataset
+            if batches is not None:
+                batches = make_batch_stream(dataset, args, device)
 
 
 if __name__ == "__main__":